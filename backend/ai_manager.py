@@ -1,76 +1,344 @@
+import asyncio
+import hashlib
+import logging
 import os
+import re
+import string
+import threading
+import zlib
+from collections import OrderedDict
+from config import Config
+
+# 线程数需要在导入torch/onnxruntime之前设置才能生效
+os.environ.setdefault("OMP_NUM_THREADS", str(Config.EMBEDDING_NUM_THREADS))
+
+import numpy as np
 import ollama
+import torch
 from sentence_transformers import SentenceTransformer
-from config import Config
+
+logger = logging.getLogger(__name__)
+
+# 回复清理：去掉换行符，连续空格合并为一个
+_STRIP_TABLE = str.maketrans("", "", "\n\r")
+_WS_RE = re.compile(r" {2,}")
+
+# 回复截断时优先选择的断句标点
+_TRUNCATE_POINTS = ('.', '。', '!', '！', '?', '？', '~', '～', '"', '”', '’')
+
+# 对话总结提示词模板
+_SUMMARY_TMPL = string.Template(
+    "用户与智子的对话总结：\n"
+    "\n"
+    "用户: $user_msg\n"
+    "智子: $assistant_msg\n"
+    "当前情感状态: $current_state\n"
+    "请总结这段对话，提取出用户的情感波动、智子的反应，并用简短的语言总结这段对话。\n"
+)
+
+def _l2_normalize(embeddings):
+    """按行L2归一化为float32；不是所有后端都支持normalize_embeddings参数（如Model2Vec），在这里统一保证"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / (norms + 1e-12)
+
+class HashEmbedder:
+    """模型无法加载时的降级向量化：字符unigram/bigram哈希到固定维度，只保证服务可用，检索质量有限"""
+    
+    def __init__(self, dim=Config.HASH_EMBEDDING_DIM):
+        self.dim = dim
+    
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for n in (1, 2):
+            for i in range(len(text) - n + 1):
+                vector[zlib.crc32(text[i:i + n].encode("utf-8")) % self.dim] += 1.0
+        return vector
+    
+    def encode(self, sentences, **kwargs):
+        """与SentenceTransformer.encode兼容，返回L2归一化的float32向量"""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        embeddings = _l2_normalize(np.stack([self._embed(text) for text in texts]))
+        return embeddings[0] if single else embeddings
+
+class CachedEmbeddingModel:
+    """嵌入模型的LRU缓存包装，按规范化文本缓存L2归一化后的float32向量"""
+    
+    def __init__(self, model, maxsize=Config.EMBEDDING_CACHE_SIZE):
+        self.model = model
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _key(text):
+        return hashlib.blake2b(text.strip().lower().encode("utf-8"), digest_size=16).digest()
+    
+    def lookup(self, text):
+        """只查缓存，未命中返回None"""
+        key = self._key(text)
+        with self._lock:
+            embedding = self._cache.get(key)
+            if embedding is not None:
+                self._cache.move_to_end(key)
+            return embedding
+    
+    def encode(self, sentences, **kwargs):
+        """与SentenceTransformer.encode兼容，只对未命中缓存的文本调用底层模型"""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        keys = [self._key(text) for text in texts]
+        embeddings = [None] * len(texts)
+        misses = []
+        
+        with self._lock:
+            for i, key in enumerate(keys):
+                embedding = self._cache.get(key)
+                if embedding is None:
+                    misses.append(i)
+                else:
+                    self._cache.move_to_end(key)
+                    embeddings[i] = embedding
+        
+        if misses:
+            kwargs.update(convert_to_numpy=True, normalize_embeddings=True)
+            encoded = _l2_normalize(self.model.encode([texts[i] for i in misses], **kwargs))
+            with self._lock:
+                for i, embedding in zip(misses, encoded):
+                    embeddings[i] = embedding
+                    self._cache[keys[i]] = embedding
+                    self._cache.move_to_end(keys[i])
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+        
+        return embeddings[0] if single else np.stack(embeddings)
+    
+    def __getattr__(self, item):
+        return getattr(self.model, item)
 
 class AIManager:
     """AI模型管理器"""
     
     def __init__(self):
         self.ollama_model = Config.OLLAMA_MODEL
+        torch.set_num_threads(Config.EMBEDDING_NUM_THREADS)
         self.embedding_model = self._load_embedding_model()
+        if self.embedding_model is None:
+            # 降级方案：哈希向量，保证记忆读写不因模型缺失而报错
+            self.embedding_model = HashEmbedder()
+        else:
+            self._warm_up_embedding_model()
+        self.embedding_model = CachedEmbeddingModel(self.embedding_model)
+        
+        # Ollama 异步调用统一在后台事件循环上执行，Flask线程只等待结果
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        self._async_client = ollama.AsyncClient(host=Config.OLLAMA_HOST, timeout=Config.OLLAMA_TIMEOUT)
+        # 流式接口在请求线程中同步迭代，使用一个共享的连接池客户端
+        self._client = ollama.Client(host=Config.OLLAMA_HOST, timeout=Config.OLLAMA_TIMEOUT)
     
     def _load_embedding_model(self):
         """加载嵌入模型"""
         try:
+            # 静态词向量模型：encode只需查表+平均池化，无需Transformer前向计算
+            if Config.EMBEDDING_BACKEND == "model2vec":
+                embedding_model = self._load_model2vec_model()
+                if embedding_model is not None:
+                    return embedding_model
+
+            device = self._resolve_embedding_device()
             # 首先尝试使用本地模型路径
             if os.path.exists(Config.LOCAL_MODEL_PATH):
-                embedding_model = SentenceTransformer(Config.LOCAL_MODEL_PATH)
-                print(f"使用本地模型: {Config.LOCAL_MODEL_PATH}")
+                # int8 ONNX模型只在CPU上有优势，有GPU时直接使用Transformer模型
+                if Config.EMBEDDING_BACKEND == "onnx" and device == "cpu":
+                    embedding_model = self._load_onnx_model(Config.LOCAL_MODEL_PATH)
+                    if embedding_model is not None:
+                        return embedding_model
+                embedding_model = SentenceTransformer(Config.LOCAL_MODEL_PATH, device=device)
+                logger.info("使用本地模型: %s (%s)", Config.LOCAL_MODEL_PATH, device)
             else:
                 # 尝试使用中文优化的小模型
-                embedding_model = SentenceTransformer(Config.FALLBACK_MODEL)
-                print("使用中文文本向量化模型")
+                embedding_model = SentenceTransformer(Config.FALLBACK_MODEL, device=device)
+                logger.info("使用中文文本向量化模型 (%s)", device)
+            embedding_model.eval()
+            if device == "cuda":
+                # GPU上使用FP16推理
+                embedding_model.half()
+                if Config.EMBEDDING_TORCH_COMPILE:
+                    self._compile_embedding_model(embedding_model)
             return embedding_model
         except Exception as e:
-            print(f"模型加载失败 {e}, 使用简化的向量化方案")
-            # 降级方案：使用简单的关键词匹配
+            logger.warning("模型加载失败 %s, 使用简化的向量化方案", e)
             return None
     
+    @staticmethod
+    def _resolve_embedding_device():
+        """解析嵌入模型运行设备"""
+        if Config.EMBEDDING_DEVICE == "auto":
+            return "cuda" if torch.cuda.is_available() else "cpu"
+        return Config.EMBEDDING_DEVICE
+    
+    @staticmethod
+    def _compile_embedding_model(embedding_model):
+        """用torch.compile编译底层Transformer，失败时保持eager模式
+
+        torch.compile在首次前向时才真正编译，因此在这里用短、长两条文本试跑，
+        编译失败时恢复原始模型，避免错误延迟到请求中出现
+        """
+        try:
+            transformer = embedding_model[0]
+            original = transformer.auto_model
+        except Exception as e:
+            logger.warning("torch.compile失败 %s, 使用eager模式", e)
+            return
+        try:
+            transformer.auto_model = torch.compile(original, dynamic=True)
+            embedding_model.encode(["预热", "预热" * 128], convert_to_numpy=True)
+            logger.info("嵌入模型已启用torch.compile")
+        except Exception as e:
+            transformer.auto_model = original
+            logger.warning("torch.compile失败 %s, 使用eager模式", e)
+    
+    def _warm_up_embedding_model(self):
+        """预热嵌入模型：第一次encode构建分词器，第二次触发推理内核选择，避免首个请求变慢
+
+        同时编码一条较长文本，使编译后的模型提前覆盖不同输入长度
+        """
+        try:
+            for _ in range(2):
+                self.embedding_model.encode("预热", convert_to_numpy=True)
+            self.embedding_model.encode("预热" * 128, convert_to_numpy=True)
+        except Exception as e:
+            logger.warning("嵌入模型预热失败: %s", e)
+    
+    def _load_model2vec_model(self):
+        """加载Model2Vec静态嵌入模型，本地不存在时从bge-small-zh蒸馏一次"""
+        try:
+            from model2vec import StaticModel
+
+            if not os.path.exists(Config.MODEL2VEC_PATH):
+                from model2vec.distill import distill
+
+                logger.info("未找到Model2Vec模型，正在从本地模型蒸馏...")
+                distilled = distill(model_name=Config.LOCAL_MODEL_PATH, pca_dims=Config.MODEL2VEC_PCA_DIMS)
+                distilled.save_pretrained(Config.MODEL2VEC_PATH)
+
+            embedding_model = StaticModel.from_pretrained(Config.MODEL2VEC_PATH)
+            logger.info("使用Model2Vec静态模型: %s", Config.MODEL2VEC_PATH)
+            return embedding_model
+        except Exception as e:
+            logger.warning("Model2Vec模型加载失败 %s, 回退到Transformer模型", e)
+            return None
+
+    def _load_onnx_model(self, model_path):
+        """加载ONNX Runtime int8量化模型，量化文件不存在时先导出一次"""
+        try:
+            import onnxruntime
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+            from sentence_transformers import export_dynamic_quantized_onnx_model
+
+            if not os.path.exists(os.path.join(model_path, Config.ONNX_MODEL_FILE)):
+                logger.info("未找到int8量化模型，正在导出ONNX模型...")
+                onnx_model = SentenceTransformer(model_path, backend="onnx")
+                # 动态量化：int8权重按通道量化，激活在推理时按张量量化；VNNI指令执行int8点积
+                quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+                export_dynamic_quantized_onnx_model(
+                    onnx_model, quantization_config, model_path, file_suffix="qint8_avx512_vnni"
+                )
+
+            sess_options = onnxruntime.SessionOptions()
+            sess_options.intra_op_num_threads = Config.EMBEDDING_NUM_THREADS
+            sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            embedding_model = SentenceTransformer(
+                model_path,
+                backend="onnx",
+                model_kwargs={
+                    "file_name": Config.ONNX_MODEL_FILE,
+                    "provider": "CPUExecutionProvider",
+                    "session_options": sess_options,
+                },
+            )
+            logger.info("使用本地ONNX int8模型: %s", os.path.join(model_path, Config.ONNX_MODEL_FILE))
+            return embedding_model
+        except Exception as e:
+            logger.warning("ONNX模型加载失败 %s, 回退到FP32模型", e)
+            return None
+
+    def submit(self, coro):
+        """将协程提交到后台事件循环，返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+    
     def get_ollama_response(self, prompt):
+        """调用本地 Ollama 模型获取响应（同步接口）"""
+        return self.submit(self.get_ollama_response_async(prompt)).result()
+    
+    async def get_ollama_response_async(self, prompt):
         """调用本地 Ollama 模型获取响应"""
         try:
-            response = ollama.generate(model=self.ollama_model, prompt=prompt, stream=False)
+            response = await self._async_client.generate(model=self.ollama_model, prompt=prompt, stream=False)
             ollama_response = response["response"]
             
             # 清理多余的空格和换行符
-            cleaned_response = ollama_response.replace('\n', '').replace('\r', '').replace('  ', ' ').strip()
+            cleaned_response = _WS_RE.sub(" ", ollama_response.translate(_STRIP_TABLE)).strip()
             
             # 限制回复长度，最多90个可见字符
-            max_length = 90
+            max_length = Config.MAX_RESPONSE_LENGTH
             if len(cleaned_response) > max_length:
-                # 在max_length以内查找合适的截断点，避免截断在中间
-                truncate_points = ['.', '。', '!', '！', '?', '？', '~', '～', '"', '”', '’']
-                # 从max_length-10开始向前查找，确保截断后的回复流畅自然
-                for i in range(max_length-1, max_length//2, -1):
-                    if cleaned_response[i] in truncate_points:
-                        return cleaned_response[:i+1]
+                # 在后半段内查找最靠后的断句标点，避免截断在中间
+                best = max(cleaned_response.rfind(c, max_length//2 + 1, max_length) for c in _TRUNCATE_POINTS)
+                if best >= 0:
+                    return cleaned_response[:best+1]
                 # 如果没有合适的截断点，直接截断
                 return cleaned_response[:max_length] + '...'
             
             return cleaned_response
         except Exception as e:
-            print(f"Ollama 调用失败: {e}")
+            logger.error("Ollama 调用失败: %s", e)
             return "抱歉，我现在有点忙，稍后再聊吧～"
     
+    def stream_ollama_response(self, prompt):
+        """以流式方式调用 Ollama，逐段产出清理后的回复，总长度不超过MAX_RESPONSE_LENGTH"""
+        remaining = Config.MAX_RESPONSE_LENGTH
+        started = False
+        try:
+            for chunk in self._client.generate(model=self.ollama_model, prompt=prompt, stream=True):
+                text = _WS_RE.sub(" ", chunk["response"].translate(_STRIP_TABLE))
+                if not started:
+                    text = text.lstrip()
+                if not text:
+                    continue
+                started = True
+                if len(text) >= remaining:
+                    yield text[:remaining]
+                    return
+                remaining -= len(text)
+                yield text
+        except Exception as e:
+            logger.error("Ollama 调用失败: %s", e)
+            if not started:
+                yield "抱歉，我现在有点忙，稍后再聊吧～"
+    
     def summarize_conversation(self, user_msg, assistant_msg, current_state):
+        """使用 LLM 总结对话并生成情感摘要（同步接口）"""
+        return self.submit(self.summarize_conversation_async(user_msg, assistant_msg, current_state)).result()
+    
+    async def summarize_conversation_async(self, user_msg, assistant_msg, current_state):
         """使用 LLM 总结对话并生成情感摘要"""
-        prompt = f"""
-        用户与智子的对话总结：
-        
-        用户: {user_msg}
-        智子: {assistant_msg}
-        当前情感状态: {current_state}
-        请总结这段对话，提取出用户的情感波动、智子的反应，并用简短的语言总结这段对话。
-        """
+        prompt = _SUMMARY_TMPL.substitute(
+            user_msg=user_msg,
+            assistant_msg=assistant_msg,
+            current_state=current_state
+        )
 
         try:
-            response = ollama.generate(
+            response = await self._async_client.generate(
                 model=Config.OLLAMA_MODEL,
                 prompt=prompt,
                 stream=False
             )
             return response["response"]
         except Exception as e:
-            print(f"调用Ollama失败: {e}")
+            logger.error("调用Ollama失败: %s", e)
             return "对话总结失败，请稍后再试。"
@@ -2,12 +2,17 @@ from flask import Flask
 from flask_cors import CORS
 from waitress import serve
 import chromadb
+import atexit
+import logging
+import logging.handlers
 import os
+import queue
 import sys
 
 # 确保能正确导入情感状态机
-if not os.path.abspath(os.path.join(os.path.dirname(__file__), 'emotion_state_serv')) in sys.path:
-    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'emotion_state_serv')))
+_EMO_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), 'emotion_state_serv'))
+if _EMO_PATH not in sys.path:
+    sys.path.append(_EMO_PATH)
 
 from config import Config
 # from memory_manager import MemoryManager
@@ -21,6 +26,18 @@ from database import init_db
 # 初始化数据库
 init_db()
 
+def setup_logging():
+    """日志经队列交给后台线程输出，请求线程只做入队"""
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    root = logging.getLogger()
+    root.setLevel(Config.LOG_LEVEL)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+
 def create_app():
     """创建Flask应用"""
     app = Flask(__name__)
@@ -48,6 +65,8 @@ def create_app():
     return app
 
 if __name__ == "__main__":
+    setup_logging()
+    
     # 创建应用实例
     app = create_app()
     
@@ -62,4 +81,4 @@ if __name__ == "__main__":
     print("  - 用户机制已集成，支持独立记忆")
     
     # 使用waitress启动服务器
-    serve(app, host=Config.FLASK_HOST, port=Config.FLASK_PORT)
+    serve(app, host=Config.FLASK_HOST, port=Config.FLASK_PORT, threads=Config.SERVER_THREADS)
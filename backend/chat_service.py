@@ -1,6 +1,32 @@
-from flask import request, jsonify
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import orjson
+from flask import request, Response, stream_with_context
 from config import Config
-from database import get_db, get_or_create_user, get_or_create_memory_collection
+from database import SessionScoped, get_or_create_user, get_or_create_memory_collection
+
+logger = logging.getLogger(__name__)
+
+# 请求内并行任务使用的线程池（记忆检索与情感状态计算重叠执行）；
+# 每个请求线程最多同时提交一个检索任务，与waitress线程数一致才不会让请求排队
+_executor = ThreadPoolExecutor(max_workers=Config.SERVER_THREADS)
+
+# MCP对话总结与记忆写入的后台线程池；积压超过PERSIST_QUEUE_SIZE时丢弃最旧的对话
+_persist_executor = ThreadPoolExecutor(max_workers=4)
+_pending_turns = deque(maxlen=Config.PERSIST_QUEUE_SIZE)
+
+# orjson直接输出UTF-8字节，中文不做\uXXXX转义
+_ORJSON_OPTS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+def _dumps(obj):
+    return orjson.dumps(obj, option=_ORJSON_OPTS).decode("utf-8")
+
+def _json_response(obj):
+    """替代jsonify；需要状态码时由调用方返回 (response, status) 元组"""
+    return Response(orjson.dumps(obj, option=_ORJSON_OPTS), mimetype="application/json")
 
 class ChatService:
     """聊天服务类"""
@@ -11,6 +37,13 @@ class ChatService:
         self.ai_manager = ai_manager
         self.prompt_generator = prompt_generator
         self.chroma_client = chroma_client
+        # 状态描述只取决于状态，来自一个很小的有限集合，缓存后每次响应只是一次字典查找
+        self._state_description = lru_cache(maxsize=16)(emotional_machine.get_state_description)
+        
+        # 邮箱 -> (用户ID, 记忆集合名)，用户与集合的对应关系创建后不再变化；
+        # 邮箱来自请求，按LRU限制条数，超出USER_CACHE_SIZE时淘汰最久未用的
+        self._user_cache: OrderedDict[str, tuple[int, str]] = OrderedDict()
+        self._user_cache_lock = threading.Lock()
     
     def register_routes(self, app):
         """注册路由"""
@@ -37,30 +70,62 @@ class ChatService:
             return self._health_check()
     
     def _handle_user_identity(self, data):
-        """处理用户身份，获取或创建用户及其记忆集合"""
+        """处理用户身份，获取或创建用户及其记忆集合，返回(用户ID, 记忆集合名)"""
         # 获取用户邮箱
         email = data.get("email", "default@example.com")
         
-        # 获取数据库会话
-        db_gen = get_db()
-        db = next(db_gen)
+        # 已知用户直接使用缓存，不访问数据库
+        with self._user_cache_lock:
+            identity = self._user_cache.get(email)
+            if identity is not None:
+                self._user_cache.move_to_end(email)
         
-        try:
-            # 获取或创建用户
-            user = get_or_create_user(db, email)
-            print(f"用户: {user.email}, ID: {user.id}")
-            
-            # 获取或创建用户的记忆集合
-            memory_collection = get_or_create_memory_collection(db, user.id, user.email)
-            print(f"记忆集合: {memory_collection.collection_name}")
-            
-            # 设置当前记忆管理器使用的集合
-            self.memory_manager.set_collection_by_name(memory_collection.collection_name)
+        if identity is None:
+            db = SessionScoped()
+            try:
+                # 获取或创建用户
+                user = get_or_create_user(db, email)
+                logger.debug("用户: %s, ID: %s", user.email, user.id)
+                
+                # 获取或创建用户的记忆集合
+                memory_collection = get_or_create_memory_collection(db, user.id, user.email)
+                logger.debug("记忆集合: %s", memory_collection.collection_name)
+                
+                identity = (user.id, memory_collection.collection_name)
+            finally:
+                # 释放当前线程的数据库会话
+                SessionScoped.remove()
             
-            return user, memory_collection
-        finally:
-            # 关闭数据库会话
-            next(db_gen, None)
+            with self._user_cache_lock:
+                self._user_cache[email] = identity
+                self._user_cache.move_to_end(email)
+                while len(self._user_cache) > Config.USER_CACHE_SIZE:
+                    self._user_cache.popitem(last=False)
+        
+        return identity
+    
+    def _retrieve_memories(self, user_msg, collection_name):
+        """编码用户消息并检索相关记忆，返回(用户消息向量, 检索结果)，向量留给记忆写入复用"""
+        user_embedding = self.memory_manager.encode(user_msg)
+        memories = self.memory_manager.retrieve_relevant_memories(
+            user_msg, collection_name=collection_name, query_embedding=user_embedding
+        )
+        return user_embedding, memories
+    
+    def _pipeline(self, user_msg, identity_data):
+        """聊天请求的前置流水线：用户身份 -> (记忆检索 ∥ 情感状态) -> 提示词，返回(用户身份, 新状态, 提示词, 用户消息向量)"""
+        # 处理用户身份，获取或创建用户及其记忆集合
+        identity = self._handle_user_identity(identity_data)
+        
+        # 检索相关记忆的同时更新情感状态（集合名随调用传入，不修改记忆管理器的共享状态）
+        memories_future = _executor.submit(self._retrieve_memories, user_msg, identity[1])
+        new_state = self.emotional_machine.determine_state(user_msg)
+        user_embedding, memories = memories_future.result()
+        
+        # 生成带有角色设定和状态的提示
+        prompt = self.prompt_generator.generate_chat_prompt(user_msg, new_state, memories)
+        
+        return identity, new_state, prompt, user_embedding
     
     def _handle_chat_request(self):
         """处理聊天请求的内部方法"""
@@ -69,35 +134,92 @@ class ChatService:
             user_msg = data.get("message", "")
             
             if not user_msg:
-                return jsonify({"error": "缺少message参数"}), 400
+                return _json_response({"error": "缺少message参数"}), 400
             
-            # 处理用户身份，获取或创建用户及其记忆集合
-            self._handle_user_identity(data)
+            # 确定用户、情感状态并生成提示
+            (_, collection_name), new_state, prompt, user_embedding = self._pipeline(user_msg, data)
             
-            # 更新情感状态
-            new_state = self.emotional_machine.determine_state(user_msg)
-            
-            # 生成带有角色设定和状态的提示
-            prompt = self.prompt_generator.generate_chat_prompt(user_msg, new_state)
+            # 流式返回：以SSE逐段推送回复
+            if data.get("stream"):
+                return Response(
+                    stream_with_context(
+                        self._stream_chat_response(collection_name, user_msg, new_state, prompt, user_embedding)
+                    ),
+                    mimetype="text/event-stream"
+                )
             
             # 调用 Ollama 获取回复
             ollama_response = self.ai_manager.get_ollama_response(prompt)
-            print(f"Ollama 回复: {ollama_response}")
+            logger.debug("Ollama 回复: %s", ollama_response)
             
-            # 存储聊天记忆
-            self.memory_manager.add_memory(user_msg, ollama_response, new_state)
+            # 存储聊天记忆（复用检索时算好的用户消息向量）
+            self.memory_manager.add_memory(
+                user_msg, ollama_response, new_state,
+                collection_name=collection_name, user_embedding=user_embedding
+            )
             
             # 返回完整回复
-            return jsonify({
+            return _json_response({
                 "response": ollama_response,
                 "current_state": new_state,
-                "state_description": self.emotional_machine.get_state_description(new_state),
+                "state_description": self._state_description(new_state),
                 "emotional_variables": self.emotional_machine.variables
             })
             
         except Exception as e:
-            print(f"聊天服务错误: {e}")
-            return jsonify({"error": f"服务器内部错误: {str(e)}"}), 500
+            logger.error("聊天服务错误: %s", e)
+            return _json_response({"error": f"服务器内部错误: {str(e)}"}), 500
+    
+    def _stream_chat_response(self, collection_name, user_msg, new_state, prompt, user_embedding=None):
+        """以SSE格式逐段推送回复，生成结束后推送状态信息并存储记忆"""
+        chunks = []
+        for chunk in self.ai_manager.stream_ollama_response(prompt):
+            chunks.append(chunk)
+            yield f"data: {_dumps({'response': chunk})}\n\n"
+        
+        ollama_response = "".join(chunks)
+        logger.debug("Ollama 回复: %s", ollama_response)
+        
+        # 存储聊天记忆
+        self.memory_manager.add_memory(
+            user_msg, ollama_response, new_state,
+            collection_name=collection_name, user_embedding=user_embedding
+        )
+        
+        done = {
+            "response": ollama_response,
+            "current_state": new_state,
+            "state_description": self._state_description(new_state),
+            "emotional_variables": self.emotional_machine.variables
+        }
+        yield f"event: done\ndata: {_dumps(done)}\n\n"
+    
+    def _schedule_persist_turn(self, collection_name, user_msg, ollama_response, new_state, user_embedding=None):
+        """将一轮对话放入后台待持久化队列，队列满时最旧的对话被丢弃"""
+        _pending_turns.append((collection_name, user_msg, ollama_response, new_state, user_embedding))
+        _persist_executor.submit(self._drain_pending_turn)
+    
+    def _drain_pending_turn(self):
+        """从待持久化队列取出一轮对话并执行（对应的对话可能已被丢弃）"""
+        try:
+            turn = _pending_turns.popleft()
+        except IndexError:
+            return
+        try:
+            self._persist_turn(*turn)
+        except Exception as e:
+            logger.error("后台存储记忆失败: %s", e)
+    
+    def _persist_turn(self, collection_name, user_msg, ollama_response, new_state, user_embedding=None):
+        """总结对话并存储聊天记忆（关闭MCP_SUMMARIZE_MEMORY时直接存储原始回复）"""
+        if Config.MCP_SUMMARIZE_MEMORY:
+            assistant_msg = self.ai_manager.summarize_conversation(user_msg, ollama_response, new_state)
+        else:
+            assistant_msg = ollama_response
+        self.memory_manager.add_memory(
+            user_msg, assistant_msg, new_state,
+            collection_name=collection_name, user_embedding=user_embedding
+        )
     
     def _handle_mcp_chat_request(self):
         """处理MCP聊天请求的内部方法"""
@@ -105,7 +227,7 @@ class ChatService:
             data = request.get_json()
             
             if not data or "method" not in data:
-                return jsonify({
+                return _json_response({
                     "jsonrpc": "2.0",
                     "error": {"code": -32700, "message": "Invalid JSON-RPC request"},
                     "id": None
@@ -119,49 +241,42 @@ class ChatService:
                 user_msg = params.get("message", "")
                 
                 if not user_msg:
-                    return jsonify({
+                    return _json_response({
                         "jsonrpc": "2.0",
                         "error": {"code": -32602, "message": "缺少message参数"},
                         "id": request_id
                     }), 400
                 
-                # 处理用户身份，获取或创建用户及其记忆集合
-                self._handle_user_identity(params)
-                
-                # 更新情感状态
-                new_state = self.emotional_machine.determine_state(user_msg)
-                
-                # 生成带有角色设定和状态的提示
-                prompt = self.prompt_generator.generate_chat_prompt(user_msg, new_state)
+                # 确定用户、情感状态并生成提示
+                (_, collection_name), new_state, prompt, user_embedding = self._pipeline(user_msg, params)
                 
                 # 调用 Ollama 获取回复
                 ollama_response = self.ai_manager.get_ollama_response(prompt)
                 
-                # 存储聊天记忆
-                summary = self.ai_manager.summarize_conversation(user_msg, ollama_response, new_state)
-                self.memory_manager.add_memory(user_msg, summary, new_state)
+                # 对话总结与记忆存储在后台完成，不阻塞回复
+                self._schedule_persist_turn(collection_name, user_msg, ollama_response, new_state, user_embedding)
                 
-                return jsonify({
+                return _json_response({
                     "jsonrpc": "2.0",
                     "result": {
                         "response": ollama_response,
                         "state": new_state,
-                        "state_description": self.emotional_machine.get_state_description(new_state),
+                        "state_description": self._state_description(new_state),
                         "variables": self.emotional_machine.variables
                     },
                     "id": request_id
                 })
             
             else:
-                return jsonify({
+                return _json_response({
                     "jsonrpc": "2.0",
                     "error": {"code": -32601, "message": f"Method not found: {method}"},
                     "id": request_id
                 }), 404
                 
         except Exception as e:
-            print(f"MCP聊天服务错误: {e}")
-            return jsonify({
+            logger.error("MCP聊天服务错误: %s", e)
+            return _json_response({
                 "jsonrpc": "2.0",
                 "error": {"code": -32603, "message": f"Internal error: {str(e)}"},
                 "id": None
@@ -169,4 +284,4 @@ class ChatService:
     
     def _health_check(self):
         """健康检查"""
-        return jsonify({"status": "ok", "service": "Ollama Chat Service with Emotion State Machine"})
+        return _json_response({"status": "ok", "service": "Ollama Chat Service with Emotion State Machine"})
@@ -8,15 +8,26 @@ class Config:
     """配置类"""
     # Ollama模型配置
     OLLAMA_MODEL = "gemma3:4b"
-    OLLAMA_URL = "http://localhost:11434/api/generate"
+    OLLAMA_HOST = "http://localhost:11434"
+    OLLAMA_URL = f"{OLLAMA_HOST}/api/generate"
+    OLLAMA_TIMEOUT = 120  # 单次生成请求超时（秒）
+    MAX_RESPONSE_LENGTH = 90  # 回复最多保留的可见字符数
     
     # 记忆配置
     MEMORY_EXPIRY_TIME = 30 * 24 * 60 * 60  # 30天
     RELEVANT_MEMORIES_COUNT = 3  # 检索相关记忆数量
+    MEMORY_BATCH_SIZE = 16  # 单次批量编码/写入的最大条数
+    MEMORY_BATCH_WAIT = 0.02  # 凑批等待时间（秒）
+    MEMORY_ENCODE_TIMEOUT = 30  # 检索时等待批量编码结果的最长时间（秒）
+    PERSIST_QUEUE_SIZE = 256  # 后台对话总结/记忆写入的最大积压数，超出时丢弃最旧的
+    MCP_SUMMARIZE_MEMORY = True  # MCP对话存储前是否先用LLM总结；关闭后与/chat一样直接存储原始回复，省去一次生成
+    USER_CACHE_SIZE = 1024  # 邮箱到用户ID/记忆集合名的LRU缓存条数
     
     # Flask应用配置
     FLASK_HOST = "0.0.0.0"
     FLASK_PORT = 9602
+    SERVER_THREADS = 16  # waitress工作线程数；请求线程大部分时间在等待Ollama生成，默认的4个会让并发用户排队
+    LOG_LEVEL = "INFO"  # 每个请求的明细日志为DEBUG级别，默认不输出
     SECRET_KEY = os.urandom(24)  # 用于会话管理
     
     # 模型配置
@@ -24,6 +35,17 @@ class Config:
     LOCAL_MODEL_PATH = os.path.join(BASE_DIR, 'models', 'bge-small-zh-v1.5', 'ai-modelscope', 'bge-small-zh-v1___5')
     FALLBACK_MODEL = 'shibing624/text2vec-base-chinese'
     
+    # 嵌入推理后端配置
+    EMBEDDING_BACKEND = "onnx"  # "onnx": ONNX Runtime int8量化推理；"torch": 原始FP32推理；"model2vec": 静态词向量
+    ONNX_MODEL_FILE = os.path.join('onnx', 'model_qint8_avx512_vnni.onnx')  # 相对于LOCAL_MODEL_PATH
+    MODEL2VEC_PATH = os.path.join(BASE_DIR, 'models', 'bge-small-zh-v1.5-m2v')  # 从本地模型蒸馏出的静态模型
+    MODEL2VEC_PCA_DIMS = 256  # 蒸馏后的向量维度（与已有Chroma集合的维度不同，切换后需使用新集合）
+    EMBEDDING_NUM_THREADS = os.cpu_count() or 1  # 嵌入推理使用的线程数
+    EMBEDDING_DEVICE = "auto"  # "auto": 有CUDA时使用GPU(FP16)，否则CPU；也可指定"cpu"/"cuda"
+    EMBEDDING_TORCH_COMPILE = True  # GPU上用torch.compile编译Transformer（CPU上编译可能变慢，不启用）
+    EMBEDDING_CACHE_SIZE = 4096  # 嵌入向量LRU缓存条数
+    HASH_EMBEDDING_DIM = 512  # 模型加载失败时哈希向量的维度，与bge-small-zh一致以兼容已有集合
+    
     # 情感状态机配置
     EMOTION_STATE_MODULE = "emo_serv"
     CHARACTER_CARD_MODULE = "character_card"
@@ -34,6 +56,14 @@ class Config:
     
     # Chroma配置
     CHROMA_PERSIST_DIRECTORY = os.path.join(BASE_DIR, 'chroma_db')  # Chroma持久化目录
+    # 向量写入前已做L2归一化，内积即余弦相似度，省去每次查询的范数计算
+    # HNSW参数只在集合创建时生效：M为每个节点的连接数，construction_ef/search_ef为建图/查询时的候选列表大小
+    CHROMA_COLLECTION_METADATA = {
+        "hnsw:space": "ip",
+        "hnsw:construction_ef": 200,
+        "hnsw:search_ef": 64,
+        "hnsw:M": 16,
+    }
     
     # Redis配置（可选）
     REDIS_URL = None  # 如果使用Redis，设置为redis://localhost:6379/0
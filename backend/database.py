@@ -1,15 +1,32 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, create_engine
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, scoped_session
 from datetime import datetime
 from config import Config
 
-# 创建SQLAlchemy引擎
-engine = create_engine(Config.DATABASE_URL, echo=True)  # 设置echo=True可以看到SQL语句
+# 创建SQLAlchemy引擎（调试时可设置echo=True查看SQL语句）
+engine = create_engine(
+    Config.DATABASE_URL,
+    echo=False,
+    connect_args={"check_same_thread": False},
+    pool_pre_ping=True
+)
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, _):
+    """SQLite连接设置：WAL模式允许读写并发，NORMAL同步级别减少fsync"""
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
 
 # 创建会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# 线程内复用的会话，供请求处理使用
+SessionScoped = scoped_session(SessionLocal)
+
 # 创建基类
 Base = declarative_base()
 
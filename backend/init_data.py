@@ -43,7 +43,10 @@ def init_chroma_db():
         chroma_client = chromadb.PersistentClient(path=Config.CHROMA_DB_PATH)
         
         # 创建默认集合
-        default_collection = chroma_client.get_or_create_collection(name="memory_default_example_com")
+        default_collection = chroma_client.get_or_create_collection(
+            name="memory_default_example_com",
+            metadata=Config.CHROMA_COLLECTION_METADATA
+        )
         print(f"已创建默认Chroma集合: {default_collection.name}")
         
         print("Chroma数据库初始化完成！")
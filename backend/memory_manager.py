@@ -1,9 +1,34 @@
 import datetime
+import hashlib
+import logging
+import queue
+import re
+import threading
 import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any
+import numpy as np
 from config import Config
 
+logger = logging.getLogger(__name__)
+
+# 旧格式记忆迁移时每次读取的条数
+_LEGACY_PAGE_SIZE = 500
+
+# 负面情感关键词：包含这些词的记忆会被遗忘
+NEGATIVE_KEYWORDS = ("失望", "生气")
+# 所有关键词编译成一个模式，一次扫描完成匹配
+_NEGATIVE_RE = re.compile("|".join(map(re.escape, NEGATIVE_KEYWORDS)))
+
+
+def _has_negative_keyword(text):
+    return _NEGATIVE_RE.search(text) is not None
+
 class Memory:
     """记忆类"""
+    __slots__ = ("memory_id", "content", "timestamp", "state")
+    
     def __init__(self, memory_id, content, timestamp, state):
         self.memory_id = memory_id
         self.content = content
@@ -14,57 +39,255 @@ class Memory:
         """检查记忆是否过期"""
         return time.time() - self.timestamp > Config.MEMORY_EXPIRY_TIME
 
+@dataclass
+class _PendingWrite:
+    """等待批量编码并写入的记忆"""
+    collection: Any
+    memory_id: str
+    content: str
+    embed_text: str  # 用于编码的文本，content只作为文档保存
+    metadata: dict
+    future: Future
+    embedding: Any = None  # 调用方已算好的向量，非None时跳过编码
+
+
+@dataclass
+class _PendingQuery:
+    """等待批量编码的检索查询"""
+    query: str
+    future: Future
+
+
 class MemoryManager:
     """记忆管理器"""
     def __init__(self, chroma_client, embedding_model, collection_name=None):
         self.chroma_client = chroma_client
         self.embedding_model = embedding_model
+        # 集合名 -> Chroma集合，避免每次请求都调用 get_or_create_collection
+        self._collections = {}
+        self._col_lock = threading.Lock()
         self.collection_name = collection_name
-        self.collection = self._get_or_create_collection()
+        self.collection = self._get_collection(collection_name) if collection_name else None
+        # 嵌入模型带缓存时，检索可在命中缓存时跳过批处理队列
+        self._cached_embedding = getattr(embedding_model, "lookup", None)
+        # 已检查过旧格式记忆的集合名
+        self._legacy_checked = set()
+        
+        # 后台批处理线程：合并并发请求的encode调用
+        self._pending = queue.Queue()
+        self._batch_thread = threading.Thread(target=self._batch_worker, daemon=True)
+        self._batch_thread.start()
+        # Chroma写入在单独线程中执行，检索编码不必等待上一批写入完成
+        self._writes = queue.Queue()
+        self._write_thread = threading.Thread(target=self._write_worker, daemon=True)
+        self._write_thread.start()
     
-    def _get_or_create_collection(self):
-        """获取或创建Chroma集合"""
-        if self.collection_name:
-            return self.chroma_client.get_or_create_collection(name=self.collection_name)
+    def _get_or_create_collection(self, collection_name=None):
+        """获取或创建Chroma集合，默认为当前集合名"""
+        collection_name = collection_name or self.collection_name
+        if collection_name:
+            return self.chroma_client.get_or_create_collection(
+                name=collection_name,
+                metadata=Config.CHROMA_COLLECTION_METADATA
+            )
         return None
     
+    def _get_collection(self, collection_name):
+        """按名称获取集合，首次使用时创建并缓存"""
+        collection = self._collections.get(collection_name)
+        if collection is None:
+            with self._col_lock:
+                collection = self._collections.get(collection_name)
+                if collection is None:
+                    collection = self._get_or_create_collection(collection_name)
+                    self._collections[collection_name] = collection
+        return collection
+    
     def set_collection_by_name(self, collection_name):
-        """根据名称设置当前集合"""
+        """根据名称设置当前集合（并发请求应改为在调用时传入collection_name）"""
         self.collection_name = collection_name
-        self.collection = self._get_or_create_collection()
+        self.collection = self._get_collection(collection_name)
     
-    def add_memory(self, user_msg, assistant_msg, state):
-        """添加聊天记忆到向量数据库"""
-        if not self.collection:
-            print("未设置记忆集合，无法添加记忆")
+    def add_memory(self, user_msg, assistant_msg, state, collection_name=None, user_embedding=None):
+        """添加聊天记忆到向量数据库
+        
+        collection_name: 目标集合名，为None时写入当前集合
+        user_embedding: 用户消息的向量（检索时已算好），传入时直接作为记忆向量，不再编码
+        
+        记忆向量只由用户消息计算，带标签的完整对话只作为文档保存
+        """
+        collection = self._get_collection(collection_name) if collection_name else self.collection
+        if not collection:
+            logger.warning("未设置记忆集合，无法添加记忆")
             return
         
         memory_content = f"用户: {user_msg}\n智子: {assistant_msg}\n状态: {state}"
-        embedding = self.embedding_model.encode(memory_content).tolist()
-        memory_id = f"memory_{datetime.datetime.now().timestamp()}"
+        content_hash = hashlib.blake2b(memory_content.encode("utf-8"), digest_size=8).hexdigest()
+        now = int(time.time())
+        memory_id = f"mem_{now}_{content_hash}"
         
-        self.collection.add(
-            ids=[memory_id],
-            documents=[memory_content],
-            embeddings=[embedding],
-            metadatas=[{
-                "timestamp": datetime.datetime.now().isoformat(),
+        # 投递到批处理队列后立即返回，编码和写入由后台线程完成
+        future = Future()
+        self._pending.put(_PendingWrite(
+            collection=collection,
+            memory_id=memory_id,
+            content=memory_content,
+            embed_text=user_msg,
+            metadata={
+                "timestamp": now,
+                # 写入时确定过期时间，清理时直接比较，不依赖清理时的配置
+                "expire_at": now + Config.MEMORY_EXPIRY_TIME,
                 "user_msg": user_msg,
                 "assistant_msg": assistant_msg,
-                "state": state
-            }]
-        )
-        print(f"已存储记忆: {user_msg} -> {assistant_msg}...")
+                "state": state,
+                # 写入时标记负面情感记忆，清理时由Chroma按元数据删除
+                "forget": _has_negative_keyword(memory_content)
+            },
+            future=future,
+            embedding=user_embedding
+        ))
+        return future
+    
+    def encode(self, text):
+        """返回文本的归一化向量，优先使用缓存，未命中时走批处理队列"""
+        embedding = self._cached_embedding(text) if self._cached_embedding else None
+        if embedding is None:
+            future = Future()
+            self._pending.put(_PendingQuery(query=text, future=future))
+            embedding = future.result(timeout=Config.MEMORY_ENCODE_TIMEOUT)
+        return embedding
 
-    def retrieve_relevant_memories(self, query, n_results=Config.RELEVANT_MEMORIES_COUNT):
-        """检索与当前查询相关的记忆"""
-        if not self.collection:
+    def retrieve_relevant_memories(self, query, n_results=Config.RELEVANT_MEMORIES_COUNT, collection_name=None, query_embedding=None):
+        """检索与当前查询相关的记忆
+        
+        collection_name: 检索的集合名，为None时使用当前集合
+        query_embedding: 调用方已算好的查询向量，为None时在此处编码
+        """
+        collection = self._get_collection(collection_name) if collection_name else self.collection
+        if not collection:
             return {"documents": [[]]}
         
-        query_embedding = self.embedding_model.encode(query).tolist()
-        results = self.collection.query(query_embeddings=[query_embedding], n_results=n_results)
+        if query_embedding is None:
+            query_embedding = self.encode(query)
+        
+        # 直接传二维ndarray，避免转换成Python float列表
+        query_embeddings = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
+        results = collection.query(query_embeddings=query_embeddings, n_results=n_results)
         return results
     
+    def _batch_worker(self):
+        """从队列中凑批：最多MEMORY_BATCH_SIZE条，整批最多等待MEMORY_BATCH_WAIT秒
+
+        批中有检索查询时不再等待，只带上队列里已有的请求立即编码
+        """
+        while True:
+            item = self._pending.get()
+            batch = [item]
+            has_query = isinstance(item, _PendingQuery)
+            deadline = time.monotonic() + Config.MEMORY_BATCH_WAIT
+            while len(batch) < Config.MEMORY_BATCH_SIZE:
+                try:
+                    if has_query:
+                        item = self._pending.get_nowait()
+                    else:
+                        item = self._pending.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                batch.append(item)
+                has_query = has_query or isinstance(item, _PendingQuery)
+            try:
+                self._flush_batch(batch)
+            except Exception as e:
+                # 意外错误只让本批失败，批处理线程继续运行
+                logger.exception("批处理记忆请求失败: %s", e)
+                self._fail_pending(batch, e)
+    
+    def _write_worker(self):
+        """合并队列中已有的写入，按集合各调用一次add"""
+        while True:
+            pairs = self._writes.get()
+            while True:
+                try:
+                    pairs.extend(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(pairs)
+            except Exception as e:
+                logger.exception("写入记忆失败: %s", e)
+                self._fail_pending([item for item, _ in pairs], e)
+    
+    @staticmethod
+    def _fail_pending(items, e):
+        """把尚未完成的Future置为异常，等待方不会一直阻塞"""
+        for item in items:
+            if not item.future.done():
+                item.future.set_exception(e)
+    
+    def _flush_batch(self, batch):
+        """一次encode整批文本，查询结果直接返回，写入交给写入线程"""
+        # 已带向量的写入不参与编码
+        to_encode = [item for item in batch if isinstance(item, _PendingQuery) or item.embedding is None]
+        if to_encode:
+            texts = [item.query if isinstance(item, _PendingQuery) else item.embed_text for item in to_encode]
+            try:
+                encoded = self.embedding_model.encode(
+                    texts,
+                    batch_size=len(texts),
+                    convert_to_numpy=True,
+                    normalize_embeddings=True
+                )
+            except Exception as e:
+                logger.error("批量编码失败: %s", e)
+                for item in batch:
+                    item.future.set_exception(e)
+                return
+            if len(encoded) != len(texts):
+                raise ValueError(f"嵌入模型返回 {len(encoded)} 条向量，期望 {len(texts)} 条")
+            encoded = iter(encoded)
+        embeddings = [
+            next(encoded) if isinstance(item, _PendingQuery) or item.embedding is None else item.embedding
+            for item in batch
+        ]
+        
+        pairs = []
+        for item, embedding in zip(batch, embeddings):
+            if isinstance(item, _PendingQuery):
+                item.future.set_result(embedding)
+            else:
+                pairs.append((item, embedding))
+        if pairs:
+            self._writes.put(pairs)
+    
+    def _write_batch(self, pairs):
+        """按集合合并写入，每个集合一次add"""
+        writes = {}
+        for item, embedding in pairs:
+            # 同一秒内内容相同的记忆ID相同，只写入一次
+            writes.setdefault(id(item.collection), {}).setdefault(item.memory_id, []).append((item, embedding))
+        
+        for by_id in writes.values():
+            items = [duplicates[0] for duplicates in by_id.values()]
+            collection = items[0][0].collection
+            try:
+                collection.add(
+                    ids=[item.memory_id for item, _ in items],
+                    documents=[item.content for item, _ in items],
+                    embeddings=np.vstack([embedding for _, embedding in items]),
+                    metadatas=[item.metadata for item, _ in items]
+                )
+            except Exception as e:
+                logger.error("批量写入记忆失败: %s", e)
+                for duplicates in by_id.values():
+                    for item, _ in duplicates:
+                        item.future.set_exception(e)
+                continue
+            for duplicates in by_id.values():
+                for item, _ in duplicates:
+                    item.future.set_result(item.memory_id)
+            for item, _ in items:
+                logger.debug("已存储记忆: %s -> %s...", item.metadata['user_msg'], item.metadata['assistant_msg'])
+    
     def check_memory_relevance(self, memory, current_state):
         """检查记忆是否仍然相关"""
         # 如果记忆的情感状态与当前状态差距大，或者时间过期，标记为"遗忘"
@@ -72,7 +295,7 @@ class MemoryManager:
             return False  # 记忆已过期
 
         # 检查是否为负面情感记忆，并根据需要删除
-        if "失望" in memory.content or "生气" in memory.content:
+        if _has_negative_keyword(memory.content):
             return False  # 忘记负面情感相关记忆
 
         # 其他逻辑：根据优先级、情感权重等进行进一步判断
@@ -81,26 +304,68 @@ class MemoryManager:
 
         return True  # 保留记忆
     
+    def _migrate_legacy_memories(self, collection):
+        """迁移旧格式记忆（ISO时间戳，没有expire_at/forget），使其能被按元数据清理
+
+        已不相关的旧记忆直接删除，其余补写数值时间戳、expire_at和forget
+        """
+        offset = 0
+        while True:
+            page = collection.get(include=["metadatas", "documents"], limit=_LEGACY_PAGE_SIZE, offset=offset)
+            ids = page.get("ids") or []
+            if not ids:
+                break
+            stale, update_ids, update_metadatas = [], [], []
+            for memory_id, metadata, document in zip(ids, page["metadatas"], page["documents"]):
+                metadata = metadata or {}
+                if "expire_at" in metadata:
+                    continue
+                timestamp = metadata.get("timestamp")
+                if isinstance(timestamp, str):
+                    try:
+                        timestamp = datetime.datetime.fromisoformat(timestamp).timestamp()
+                    except ValueError:
+                        timestamp = None
+                timestamp = int(timestamp if timestamp is not None else time.time())
+                memory = Memory(memory_id, document or "", timestamp, metadata.get("state", "idle"))
+                if not self.check_memory_relevance(memory, current_state="idle"):
+                    stale.append(memory_id)
+                    continue
+                update_ids.append(memory_id)
+                update_metadatas.append({
+                    **metadata,
+                    "timestamp": timestamp,
+                    "expire_at": timestamp + Config.MEMORY_EXPIRY_TIME,
+                    "forget": False
+                })
+            if update_ids:
+                collection.update(ids=update_ids, metadatas=update_metadatas)
+            if stale:
+                collection.delete(ids=stale)
+                logger.info("已删除 %d 条旧格式记忆", len(stale))
+            if len(ids) < _LEGACY_PAGE_SIZE:
+                break
+            # 删除的记录不再占用偏移
+            offset += len(ids) - len(stale)
+    
     def clean_up_memory(self):
         """定期清理不相关或过期的记忆"""
         if not self.collection:
             return
             
         try:
-            all_memories = self.collection.get()
-            if all_memories and all_memories.get('ids'):
-                for i, memory_id in enumerate(all_memories['ids']):
-                    metadata = all_memories['metadatas'][i] if all_memories.get('metadatas') else {}
-                    # 创建临时内存对象用于检查
-                    temp_memory = Memory(
-                        memory_id=memory_id,
-                        content=all_memories['documents'][i] if all_memories.get('documents') else "",
-                        timestamp=datetime.datetime.fromisoformat(metadata.get('timestamp', datetime.datetime.now().isoformat())).timestamp() if metadata.get('timestamp') else time.time(),
-                        state=metadata.get('state', 'idle')
-                    )
-                    
-                    if not self.check_memory_relevance(temp_memory, current_state="idle"):
-                        self.collection.delete(ids=[memory_id])
-                        print(f"删除记忆: {memory_id}")
+            if self.collection_name not in self._legacy_checked:
+                self._migrate_legacy_memories(self.collection)
+                self._legacy_checked.add(self.collection_name)
+            # 与 check_memory_relevance 相同的规则，全部交给Chroma按元数据过滤后一次删除
+            now = int(time.time())
+            self.collection.delete(where={"$or": [
+                {"expire_at": {"$lt": now}},
+                # 没有expire_at的旧记忆按写入时间判断
+                {"timestamp": {"$lt": now - Config.MEMORY_EXPIRY_TIME}},
+                {"forget": True},
+                {"state": {"$ne": "idle"}}
+            ]})
+            logger.info("已清理过期和不相关的记忆")
         except Exception as e:
-            print(f"清理记忆时出错: {e}")
+            logger.error("清理记忆时出错: %s", e)
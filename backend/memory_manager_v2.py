@@ -2,12 +2,30 @@
 #  MemoryManager V2 (Improved, Thread-Safe, Multi-User, Stable)
 # ============================================================
 
+import hashlib
 import time
 import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Optional
+import numpy as np
 from chromadb import PersistentClient
 
 
+# 热路径上使用的元数据字段，转成 namedtuple 后以属性访问代替重复的 dict 查找
+Meta = namedtuple("Meta", "user_id memory_type importance created_at last_access")
+
+
+def _to_meta(meta: Dict[str, Any]) -> Meta:
+    return Meta(
+        meta["user_id"],
+        meta["memory_type"],
+        float(meta.get("importance", 0.3)),
+        meta["created_at"],
+        meta["last_access"],
+    )
+
+
 class MemoryManagerV2:
     """
     Fully redesigned memory manager with:
@@ -31,15 +49,29 @@ class MemoryManagerV2:
         self.client = PersistentClient(path=persist_dir)
         self.collection = self.client.get_or_create_collection(
             name=collection_name,
-            metadata={"hnsw:space": "cosine"},
+            # 默认嵌入函数输出已归一化，内积距离与余弦距离等价
+            metadata={
+                "hnsw:space": "ip",
+                "hnsw:construction_ef": 200,
+                "hnsw:search_ef": 64,
+                "hnsw:M": 16,
+            },
         )
 
         self.lock = threading.Lock()
+        # last_access 写回在单独线程中串行执行，不阻塞检索
+        self._writeback = ThreadPoolExecutor(max_workers=1)
 
         self.max_items_per_user = max_items_per_user
         self.short_term_expire_sec = short_term_expire_sec
         self.history_expire_sec = history_expire_sec
 
+        # 预热：加载默认嵌入函数并触发一次索引查询，避免首个请求变慢
+        try:
+            self.collection.query(query_texts=["预热"], n_results=1)
+        except Exception:
+            pass
+
     # --------------------------------------------------------
     # PUBLIC API (保持与 V1 相同的函数名与参数格式)
     # --------------------------------------------------------
@@ -62,7 +94,8 @@ class MemoryManagerV2:
 
         with self.lock:
             ts = int(time.time())
-            memory_id = f"{user_id}_{ts}_{abs(hash(content))}"
+            content_hash = hashlib.blake2b(content.encode("utf-8"), digest_size=8).hexdigest()
+            memory_id = f"{user_id}_{ts}_{content_hash}"
 
             self.collection.add(
                 ids=[memory_id],
@@ -98,61 +131,70 @@ class MemoryManagerV2:
                 n_results=limit * 3
             )
 
-            if not results or len(results["ids"][0]) == 0:
-                return []
-
-            docs = results["documents"][0]
-            ids = results["ids"][0]
-            metadatas = results["metadatas"][0]
-            scores = results["distances"][0]   # cosine distance
-
-            now = int(time.time())
-            processed = []
-
-            for doc, meta, dist, mid in zip(docs, metadatas, scores, ids):
+        if not results or len(results["ids"][0]) == 0:
+            return []
 
-                # 转换 cosine distance -> similarity
-                sim = 1 - dist
+        docs = results["documents"][0]
+        ids = results["ids"][0]
+        metadatas = results["metadatas"][0]
+        scores = results["distances"][0]   # ip distance (= cosine distance)
 
-                recency = 1.0 - min(1.0, (now - meta["last_access"]) / 86400)
-
-                weighted_score = (
-                    sim * 0.7 +
-                    recency * 0.2 +
-                    float(meta.get("importance", 0.3)) * 0.1
-                )
-
-                processed.append({
-                    "id": mid,
-                    "content": doc,
-                    "metadata": meta,
-                    "score": weighted_score
-                })
-
-                # 更新 last_access（LRU）
-                meta["last_access"] = now
-                self.collection.update(
-                    ids=[mid],
-                    metadatas=[meta]
-                )
-
-            # 排序
-            processed.sort(key=lambda x: x["score"], reverse=True)
+        now = int(time.time())
+        n = len(ids)
+
+        # 按列取出元数据字段，向量化计算加权得分
+        columns = Meta(*zip(*map(_to_meta, metadatas)))
+        dist = np.asarray(scores, dtype=np.float32)
+        last_access = np.asarray(columns.last_access, dtype=np.int64)
+        importance = np.asarray(columns.importance, dtype=np.float32)
+
+        # 转换 distance -> similarity
+        sim = 1 - dist
+        recency = 1.0 - np.minimum(1.0, (now - last_access) / 86400.0)
+        weighted = sim * 0.7 + recency * 0.2 + importance * 0.1
+
+        # 只对 top N 排序
+        k = min(limit, n)
+        if k <= 0:
+            return []
+        top_idx = np.argpartition(-weighted, k - 1)[:k]
+        top_idx = top_idx[np.argsort(-weighted[top_idx], kind="stable")]
+
+        top = [
+            {
+                "id": ids[i],
+                "content": docs[i],
+                "metadata": metadatas[i],
+                "score": float(weighted[i])
+            }
+            for i in top_idx
+        ]
+
+        # 更新 last_access（LRU）：只更新实际返回的记忆，后台一次批量写回
+        for item in top:
+            item["metadata"]["last_access"] = now
+        self._writeback.submit(
+            self._write_back_last_access,
+            [item["id"] for item in top],
+            [item["metadata"] for item in top]
+        )
 
-            # 返回 top N
-            return processed[:limit]
+        # 返回 top N
+        return top
 
     def clear_user_memory(self, user_id: str):
         """清空某用户所有记忆"""
         with self.lock:
-            items = self.collection.get(where={"user_id": user_id})
-            for i in items["ids"]:
-                self.collection.delete(ids=[i])
+            self.collection.delete(where={"user_id": user_id})
 
     # --------------------------------------------------------
     # INTERNAL MAINTENANCE
     # --------------------------------------------------------
 
+    def _write_back_last_access(self, ids: List[str], metadatas: List[Dict[str, Any]]):
+        """批量写回 last_access；检索结果不依赖写回是否成功"""
+        self.collection.update(ids=ids, metadatas=metadatas)
+
     def _prune_user_memory(self, user_id: str):
         """Memory 清理策略"""
 
@@ -164,12 +206,13 @@ class MemoryManagerV2:
             return
 
         now = int(time.time())
+        rows = [_to_meta(meta) for meta in metas]
         to_delete = []
 
         # rule 1: 清理 short-term / history 过期
-        for mid, meta in zip(ids, metas):
-            t = meta["memory_type"]
-            age = now - meta["created_at"]
+        for mid, row in zip(ids, rows):
+            t = row.memory_type
+            age = now - row.created_at
 
             if t == "shortterm" and age > self.short_term_expire_sec:
                 to_delete.append(mid)
@@ -178,19 +221,19 @@ class MemoryManagerV2:
 
         # rule 2: 超过数量上限后清理 importance 最低的
         if len(ids) - len(to_delete) > self.max_items_per_user:
+            expired = set(to_delete)
             survivors = [
-                (mid, meta)
-                for mid, meta in zip(ids, metas)
-                if mid not in to_delete
+                (mid, row)
+                for mid, row in zip(ids, rows)
+                if mid not in expired
             ]
 
-            survivors.sort(key=lambda x: x[1].get("importance", 0.3))
+            survivors.sort(key=lambda x: x[1].importance)
             excess = len(survivors) - self.max_items_per_user
 
             for i in range(excess):
                 to_delete.append(survivors[i][0])
 
-        # 执行删除
+        # 执行删除（一次批量删除）
         if to_delete:
-            for mid in to_delete:
-                self.collection.delete(ids=[mid])
+            self.collection.delete(ids=to_delete)
@@ -11,14 +11,18 @@ import importlib
 import importlib.util
 import logging
 import os
+import sys
 import threading
-import traceback
+import time
 from types import ModuleType
 from typing import Any, Dict, List, Optional
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-if not logger.handlers:
+
+
+def _attach_default_handler():
+    """Attach a stream handler; only used when the host app configured no logging."""
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
     formatter = logging.Formatter(
@@ -28,6 +32,14 @@ if not logger.handlers:
     logger.addHandler(ch)
 
 
+def _cached_import(module_name: str, item_name: str):
+    """Import module_name (checking sys.modules first) and return one attribute."""
+    modules = sys.modules
+    if module_name not in modules:
+        importlib.import_module(module_name)
+    return getattr(modules[module_name], item_name)
+
+
 class MemoryManagerWrapper:
     def __init__(
         self,
@@ -43,43 +55,112 @@ class MemoryManagerWrapper:
             v1_filename: 原始 v1 文件名（相对于 backend_dir）
             v2_init_kwargs: 传入给 MemoryManagerV2 的构造参数
         """
+        if not logger.handlers and not logging.getLogger().handlers:
+            _attach_default_handler()
+
         # 控制优先级标志：默认优先使用 v2
         self._force_v1 = False
         self._force_v2 = False
         self._lock = threading.RLock()
 
+        # v2 熔断：连续失败达到阈值后在冷却期内直接走 v1
+        self._v2_failcount = 0
+        self._v2_disabled_until = 0.0
+
+        # health_check 结果短时缓存
+        self._hc_cache: Optional[Dict[str, Any]] = None
+        self._hc_expiry = 0.0
+
         # 1) load v2 via normal import (prefer installed module or file in path)
         self._v2 = None
         try:
-            v2_mod = importlib.import_module(v2_module_name)
             # MemoryManagerV2 class expected in module
-            v2_cls = getattr(v2_mod, "MemoryManagerV2", None)
-            if v2_cls is None:
+            try:
+                v2_cls = _cached_import(v2_module_name, "MemoryManagerV2")
+            except AttributeError:
                 raise ImportError(f"{v2_module_name} does not expose MemoryManagerV2")
             self._v2 = v2_cls(**v2_init_kwargs)
             logger.info("Loaded MemoryManagerV2 via import %s", v2_module_name)
         except Exception as e:
             logger.warning("Cannot import MemoryManagerV2 via module '%s': %s", v2_module_name, e)
-            logger.debug(traceback.format_exc())
+            logger.debug("traceback:", exc_info=True)
             self._v2 = None
 
-        # 2) Dynamically load original memory_manager.py (v1) by file path
+        # 2) Original memory_manager.py (v1) is loaded lazily by file path, see _ensure_v1()
         # Determine backend dir
         if backend_dir is None:
             # file is located in backend/ relative to this wrapper file
             wrapper_dir = os.path.dirname(os.path.abspath(__file__))
             backend_dir = wrapper_dir  # wrapper is already in backend/
-        v1_path = os.path.join(backend_dir, v1_filename)
+        self._v1_path = os.path.join(backend_dir, v1_filename)
         self._v1_mod: Optional[ModuleType] = None
         self._v1 = None
-        if os.path.exists(v1_path):
+        # v1 延迟加载：只在真正需要 fallback 时才执行 exec_module
+        self._v1_loaded = False
+        self._v1_load_lock = threading.Lock()
+
+        # If v2 was not importable, load v1 now and use it as default
+        if self._v2 is None:
+            self._ensure_v1()
+        if self._v2 is None and self._v1 is not None:
+            logger.info("No v2 available; defaulting to v1 instance.")
+        elif self._v2 is None and self._v1 is None:
+            logger.error("Neither v2 nor v1 memory managers are available. Wrapper will be non-functional until one is provided.")
+
+        # Resolve each public method's (v2, v1) implementation once
+        self._resolve_impls()
+
+    # ---------------------------
+    # Helper: lazy v1 loading
+    # ---------------------------
+    # 进程级 v1 模块缓存，key 为 (绝对路径, mtime)
+    _V1_MODULE_NAME = "memory_manager_v1_dynamic"
+    _V1_MODULE_CACHE: Dict[tuple, ModuleType] = {}
+    _V1_CACHE_LOCK = threading.Lock()
+
+    def _ensure_v1(self):
+        """Load v1 from file on first use (double-checked, thread-safe)."""
+        if self._v1_loaded:
+            return
+        with self._v1_load_lock:
+            if self._v1_loaded:
+                return
+            self._load_v1()
+            # v1 方法在加载后才可解析；先更新 _impls 再置位，避免无锁读到旧值
+            self._resolve_impls()
+            self._v1_loaded = True
+
+    @classmethod
+    def _load_v1_module(cls, v1_path: str) -> ModuleType:
+        """Exec v1 once per (path, mtime) and share the module across wrapper instances."""
+        abspath = os.path.abspath(v1_path)
+        key = (abspath, os.path.getmtime(abspath))
+        m = cls._V1_MODULE_CACHE.get(key)
+        if m is not None:
+            return m
+        with cls._V1_CACHE_LOCK:
+            m = cls._V1_MODULE_CACHE.get(key)
+            if m is not None:
+                return m
+            spec = importlib.util.spec_from_file_location(cls._V1_MODULE_NAME, abspath)
+            m = importlib.util.module_from_spec(spec)
+            loader = spec.loader
+            if loader is None:
+                raise ImportError("spec.loader is None while loading v1")
+            # 先注册到 sys.modules，模块内部的相互导入才能正常解析
+            sys.modules[cls._V1_MODULE_NAME] = m
             try:
-                spec = importlib.util.spec_from_file_location("memory_manager_v1_dynamic", v1_path)
-                m = importlib.util.module_from_spec(spec)
-                loader = spec.loader
-                if loader is None:
-                    raise ImportError("spec.loader is None while loading v1")
                 loader.exec_module(m)  # type: ignore
+            except Exception:
+                sys.modules.pop(cls._V1_MODULE_NAME, None)
+                raise
+            cls._V1_MODULE_CACHE[key] = m
+            return m
+
+    def _load_v1(self):
+        if os.path.exists(self._v1_path):
+            try:
+                m = self._load_v1_module(self._v1_path)
                 self._v1_mod = m
                 # try to find common class name or factory
                 v1_cls = getattr(m, "MemoryManager", None) or getattr(m, "MemoryManagerV1", None) or None
@@ -90,24 +171,88 @@ class MemoryManagerWrapper:
                     # instantiate if it has a constructor signature
                     try:
                         self._v1 = v1_cls()
-                        logger.info("Instantiated MemoryManagerV1 from %s", v1_path)
+                        logger.info("Instantiated MemoryManagerV1 from %s", self._v1_path)
                     except Exception:
                         logger.info("MemoryManagerV1 class exists but failed to instantiate without args; keeping module for calling functions.")
                         self._v1 = None
-                logger.info("Loaded original memory manager module from %s", v1_path)
+                logger.info("Loaded original memory manager module from %s", self._v1_path)
             except Exception as e:
-                logger.error("Failed to dynamically load v1 memory manager from %s: %s", v1_path, e)
-                logger.debug(traceback.format_exc())
+                logger.error("Failed to dynamically load v1 memory manager from %s: %s", self._v1_path, e)
+                logger.debug("traceback:", exc_info=True)
                 self._v1_mod = None
                 self._v1 = None
         else:
-            logger.warning("v1 memory manager file not found at %s", v1_path)
+            logger.warning("v1 memory manager file not found at %s", self._v1_path)
 
-        # If v2 was not importable, but v1 exists and exposes a class, use v1 as default
-        if self._v2 is None and self._v1 is not None:
-            logger.info("No v2 available; defaulting to v1 instance.")
-        elif self._v2 is None and self._v1 is None:
-            logger.error("Neither v2 nor v1 memory managers are available. Wrapper will be non-functional until one is provided.")
+    # ---------------------------
+    # Helper: resolve implementations once
+    # ---------------------------
+    _DISPATCHED = ("add_memory", "retrieve_relevant_memories", "clear_user_memory", "delete_memory")
+    _V2_MAX_FAILURES = 3
+    _V2_COOLDOWN_SEC = 60.0
+    _HEALTH_CHECK_TTL = 1.0
+
+    def _resolve(self, name: str):
+        """Return (v2_fn, v1_fn) for a method name; either may be None."""
+        v2_fn = getattr(self._v2, name, None)
+        v1_fn = getattr(self._v1, name, None) or getattr(self._v1_mod, name, None)
+        return v2_fn, v1_fn
+
+    def _resolve_impls(self):
+        self._impls = {name: self._resolve(name) for name in self._DISPATCHED}
+
+    def _dispatch(self, name: str, default: Any, *args, **kwargs):
+        """Call the cached v2 implementation, falling back to v1 on failure."""
+        # 不加锁：_force_v1/_force_v2 与 _impls 只在 setter 中整体替换，读取是安全的；
+        # 熔断计数在并发下只是近似值
+        v2_fn = self._impls[name][0]
+        # Try V2 first; while the breaker is open, still use v2 if v1 cannot serve this method
+        if v2_fn is not None and (
+            self._use_v2() or (not self._force_v1 and not self._has_v1_impl(name))
+        ):
+            try:
+                result = v2_fn(*args, **kwargs)
+                self._v2_failcount = 0
+                return result
+            except Exception as e:
+                # 没有 v1 实现兜底时不计入熔断，否则冷却期内的调用会被直接丢弃
+                if self._has_v1_impl(name):
+                    self._record_v2_failure(name, e)
+                else:
+                    logger.error("MemoryManagerV2.%s failed: %s", name, e)
+                # fallback to v1 if available
+        # Try V1 (loaded on first fallback)
+        if not self._v1_loaded:
+            self._ensure_v1()
+        v1_fn = self._impls[name][1]
+        if v1_fn is None:
+            logger.error("No suitable %s implementation found in v1.", name)
+            return default
+        try:
+            return v1_fn(*args, **kwargs)
+        except Exception as e:
+            logger.error("Fallback v1.%s also failed: %s", name, e)
+            logger.debug("traceback:", exc_info=True)
+        return default
+
+    def _has_v1_impl(self, name: str) -> bool:
+        """Whether v1 provides `name` (loads v1 on first call)."""
+        if not self._v1_loaded:
+            self._ensure_v1()
+        return self._impls[name][1] is not None
+
+    def _record_v2_failure(self, name: str, e: Exception):
+        """Count a v2 failure; trip the breaker after _V2_MAX_FAILURES in a row."""
+        self._v2_failcount += 1
+        if self._v2_failcount >= self._V2_MAX_FAILURES:
+            self._v2_failcount = 0
+            self._v2_disabled_until = time.monotonic() + self._V2_COOLDOWN_SEC
+            logger.exception(
+                "MemoryManagerV2.%s failed: %s; disabling v2 for %.0fs",
+                name, e, self._V2_COOLDOWN_SEC
+            )
+        else:
+            logger.error("MemoryManagerV2.%s failed: %s", name, e)
 
     # ---------------------------
     # Helper: choose active backend
@@ -117,6 +262,8 @@ class MemoryManagerWrapper:
             return False
         if self._force_v2:
             return True
+        if time.monotonic() < self._v2_disabled_until:
+            return False
         return self._v2 is not None
 
     def force_use_v1(self, enable: bool = True):
@@ -124,6 +271,8 @@ class MemoryManagerWrapper:
             self._force_v1 = enable
             if enable:
                 self._force_v2 = False
+            self._resolve_impls()
+            self._hc_expiry = 0.0
             logger.info("force_use_v1 set to %s", enable)
 
     def force_use_v2(self, enable: bool = True):
@@ -131,6 +280,8 @@ class MemoryManagerWrapper:
             self._force_v2 = enable
             if enable:
                 self._force_v1 = False
+            self._resolve_impls()
+            self._hc_expiry = 0.0
             logger.info("force_use_v2 set to %s", enable)
 
     # ---------------------------
@@ -138,95 +289,25 @@ class MemoryManagerWrapper:
     # ---------------------------
     def add_memory(self, *args, **kwargs) -> Optional[str]:
         """Add memory. Returns memory_id or None."""
-        with self._lock:
-            # Try V2 first
-            if self._use_v2():
-                try:
-                    return self._v2.add_memory(*args, **kwargs)
-                except Exception as e:
-                    logger.error("MemoryManagerV2.add_memory failed: %s", e)
-                    logger.debug(traceback.format_exc())
-                    # fallback to v1 if available
-            # Try V1
-            try:
-                # If v1 was instantiated as an object with same API
-                if self._v1 is not None and hasattr(self._v1, "add_memory"):
-                    return self._v1.add_memory(*args, **kwargs)
-                # else module-level function?
-                if self._v1_mod is not None and hasattr(self._v1_mod, "add_memory"):
-                    return getattr(self._v1_mod, "add_memory")(*args, **kwargs)
-                logger.error("No suitable add_memory implementation found in v1.")
-            except Exception as e:
-                logger.error("Fallback v1.add_memory also failed: %s", e)
-                logger.debug(traceback.format_exc())
-            return None
+        return self._dispatch("add_memory", None, *args, **kwargs)
 
     def retrieve_relevant_memories(self, *args, **kwargs) -> List[Dict[str, Any]]:
         """Return list of memories (try v2 first, fallback to v1)"""
-        with self._lock:
-            if self._use_v2():
-                try:
-                    return self._v2.retrieve_relevant_memories(*args, **kwargs)
-                except Exception as e:
-                    logger.error("MemoryManagerV2.retrieve_relevant_memories failed: %s", e)
-                    logger.debug(traceback.format_exc())
-
-            # fallback
-            try:
-                if self._v1 is not None and hasattr(self._v1, "retrieve_relevant_memories"):
-                    return self._v1.retrieve_relevant_memories(*args, **kwargs)
-                if self._v1_mod is not None and hasattr(self._v1_mod, "retrieve_relevant_memories"):
-                    return getattr(self._v1_mod, "retrieve_relevant_memories")(*args, **kwargs)
-                logger.error("No suitable retrieve_relevant_memories in v1.")
-            except Exception as e:
-                logger.error("Fallback v1.retrieve_relevant_memories failed: %s", e)
-                logger.debug(traceback.format_exc())
-            return []
+        return self._dispatch("retrieve_relevant_memories", [], *args, **kwargs)
 
     def clear_user_memory(self, *args, **kwargs) -> bool:
-        with self._lock:
-            if self._use_v2():
-                try:
-                    return self._v2.clear_user_memory(*args, **kwargs)
-                except Exception as e:
-                    logger.error("MemoryManagerV2.clear_user_memory failed: %s", e)
-                    logger.debug(traceback.format_exc())
-
-            try:
-                if self._v1 is not None and hasattr(self._v1, "clear_user_memory"):
-                    return self._v1.clear_user_memory(*args, **kwargs)
-                if self._v1_mod is not None and hasattr(self._v1_mod, "clear_user_memory"):
-                    return getattr(self._v1_mod, "clear_user_memory")(*args, **kwargs)
-                logger.error("No suitable clear_user_memory in v1.")
-            except Exception as e:
-                logger.error("Fallback v1.clear_user_memory failed: %s", e)
-                logger.debug(traceback.format_exc())
-            return False
+        return self._dispatch("clear_user_memory", False, *args, **kwargs)
 
     # Utility: delete single memory id
     def delete_memory(self, memory_id: str) -> bool:
-        with self._lock:
-            if self._use_v2():
-                try:
-                    if hasattr(self._v2, "delete_memory"):
-                        return self._v2.delete_memory(memory_id)
-                except Exception as e:
-                    logger.error("MemoryManagerV2.delete_memory failed: %s", e)
-                    logger.debug(traceback.format_exc())
-            # fallback
-            try:
-                if self._v1 is not None and hasattr(self._v1, "delete_memory"):
-                    return self._v1.delete_memory(memory_id)
-                if self._v1_mod is not None and hasattr(self._v1_mod, "delete_memory"):
-                    return getattr(self._v1_mod, "delete_memory")(memory_id)
-            except Exception as e:
-                logger.error("Fallback v1.delete_memory failed: %s", e)
-                logger.debug(traceback.format_exc())
-            return False
+        return self._dispatch("delete_memory", False, memory_id)
 
     # Health check (try simple op on active backend)
     def health_check(self) -> Dict[str, Any]:
-        res = {"v2": False, "v1": False, "active": None, "errors": []}
+        now = time.monotonic()
+        if now < self._hc_expiry:
+            return self._hc_cache
+        res = {"v2": False, "v1": False, "v1_loaded": False, "active": None, "errors": []}
         # Check v2
         if self._v2 is not None:
             try:
@@ -237,10 +318,14 @@ class MemoryManagerWrapper:
                 res["v2"] = True
             except Exception as e:
                 res["errors"].append(f"v2: {e}")
-                logger.debug(traceback.format_exc())
+                logger.debug("traceback:", exc_info=True)
 
-        # Check v1
-        if self._v1 is not None or self._v1_mod is not None:
+        # Check v1; it stays unloaded until v2 is unavailable or fails
+        use_v2 = self._use_v2()
+        if not use_v2:
+            self._ensure_v1()
+        res["v1_loaded"] = self._v1_loaded
+        if self._v1_loaded and (self._v1 is not None or self._v1_mod is not None):
             try:
                 # if instantiated object, check it's callable methods
                 if self._v1 is not None and hasattr(self._v1, "retrieve_relevant_memories"):
@@ -249,9 +334,17 @@ class MemoryManagerWrapper:
                     res["v1"] = True
             except Exception as e:
                 res["errors"].append(f"v1: {e}")
-                logger.debug(traceback.format_exc())
+                logger.debug("traceback:", exc_info=True)
 
-        res["active"] = "v2" if self._use_v2() else "v1"
+        if use_v2:
+            res["active"] = "v2"
+        elif res["v1"]:
+            res["active"] = "v1"
+        elif self._v2 is not None and not self._force_v1:
+            # 熔断中但 v1 不可用，调用仍会走 v2
+            res["active"] = "v2"
+        self._hc_cache = res
+        self._hc_expiry = now + self._HEALTH_CHECK_TTL
         return res
 
     # Generic passthrough for methods not explicitly wrapped (use with caution)
@@ -267,6 +360,7 @@ class MemoryManagerWrapper:
         if self._use_v2() and self._v2 is not None and hasattr(self._v2, item):
             return getattr(self._v2, item)
         # fallback v1 instance
+        self._ensure_v1()
         if self._v1 is not None and hasattr(self._v1, item):
             return getattr(self._v1, item)
         # fallback v1 module-level
@@ -10,7 +10,31 @@ This module is designed to work with:
 - ai_manager.py
 """
 
-from typing import List, Optional, Dict
+from operator import itemgetter
+from typing import Any, List, Optional, Dict
+
+from memory_manager import MemoryManager as MemoryManagerV1
+
+# 默认角色：智子妹妹人格
+_DEFAULT_SYSTEM_PROMPT = (
+    "你是一位名叫「智子」的妹妹，聪明、温柔、贴心，语气自然、亲昵。"
+    "你的任务是陪伴、解释问题、安抚情绪，不使用机械化语气。"
+)
+_DEFAULT_TAIL = "\n\n请以智子的身份自然地回应。"
+_role_content = itemgetter("role", "content")
+
+
+def _memory_texts(result: Any) -> List[str]:
+    """
+    Normalise retrieval results to a list of memory texts.
+    v1 返回 Chroma 的 query 结果字典，v2 / wrapper 返回 [{"content": ...}, ...]
+    """
+    if not result:
+        return []
+    if isinstance(result, dict):
+        documents = result.get("documents") or [[]]
+        return list(documents[0] or [])
+    return [m.get("content", m) if isinstance(m, dict) else m for m in result]
 
 class PromptBuilder:
     """
@@ -28,11 +52,26 @@ class PromptBuilder:
         memory_mgr=None,
         emotion_serv=None,
         max_history: int = 8,
+        retrieve_by_user: Optional[bool] = None,
     ):
         self.character_card = character_card
         self.memory_mgr = memory_mgr
         self.emotion_serv = emotion_serv
         self.max_history = max_history
+        # wrapper / v2 的 retrieve_relevant_memories 需要 (user_id, query)，
+        # v1 是 (query, ...)，其它实现可能只有 retrieve(query)；
+        # 调用方式可由 retrieve_by_user 显式指定，未指定时按类型判断
+        self._retrieve = getattr(memory_mgr, "retrieve_relevant_memories", None)
+        if self._retrieve:
+            if retrieve_by_user is None:
+                retrieve_by_user = not isinstance(memory_mgr, MemoryManagerV1)
+        else:
+            self._retrieve = getattr(memory_mgr, "retrieve", None)
+            retrieve_by_user = bool(retrieve_by_user)
+        self._retrieve_by_user = retrieve_by_user
+        # 系统提示与结尾在构造时确定，之后每轮直接复用
+        self._system_prompt = character_card or _DEFAULT_SYSTEM_PROMPT
+        self._default_tail = _DEFAULT_TAIL
 
     # =========================
     #  System Prompt
@@ -42,35 +81,34 @@ class PromptBuilder:
         Provide a stable character identity.
         If character_card is None, load default one.
         """
-        if self.character_card:
-            return self.character_card
-
-        # 默认角色：智子妹妹人格
-        return (
-            "你是一位名叫「智子」的妹妹，聪明、温柔、贴心，语气自然、亲昵。"
-            "你的任务是陪伴、解释问题、安抚情绪，不使用机械化语气。"
-        )
+        return self._system_prompt
 
     # =========================
     #  Memory
     # =========================
-    def build_memory_context(self, user_query: str) -> str:
+    def build_memory_context(self, user_query: str, user_id: Optional[str] = None) -> str:
         """
         Inject memory retrieved from memory_manager_v2 / wrapper.
         """
-        if not self.memory_mgr:
+        if not self._retrieve:
+            return ""
+        # 按用户检索的实现没有 user_id 时跳过，避免用错参数调用
+        if self._retrieve_by_user and user_id is None:
             return ""
 
         try:
-            memories = self.memory_mgr.retrieve(user_query)
+            if self._retrieve_by_user:
+                result = self._retrieve(user_id, user_query)
+            else:
+                result = self._retrieve(user_query)
+            memories = _memory_texts(result)
         except Exception:
             memories = []
 
         if not memories:
             return ""
 
-        memory_text = "\n".join(f"- {m}" for m in memories)
-        return f"【相关记忆】\n{memory_text}\n"
+        return "【相关记忆】\n- " + "\n- ".join(map(str, memories)) + "\n"
 
     # =========================
     #  Emotion State
@@ -100,12 +138,14 @@ class PromptBuilder:
 
         useful_history = history[-self.max_history:]
 
-        s = "【最近对话】\n"
-        for turn in useful_history:
-            role = "你" if turn["role"] == "user" else "智子"
-            s += f"{role}：{turn['content']}\n"
+        parts = ["【最近对话】\n"]
+        append = parts.append
+        for role, content in map(_role_content, useful_history):
+            append("你：" if role == "user" else "智子：")
+            append(content)
+            append("\n")
 
-        return s
+        return "".join(parts)
 
     # =========================
     # Final Builder
@@ -114,26 +154,28 @@ class PromptBuilder:
         self,
         user_query: str,
         history: List[Dict] = None,
+        user_id: Optional[str] = None,
     ) -> str:
         """
         Build the final prompt sent to the model.
         """
 
-        system_prompt = self.build_system_prompt()
-        memory_prompt = self.build_memory_context(user_query)
-        emotion_prompt = self.build_emotion_prompt()
-        history_prompt = self.build_history_prompt(history or [])
+        parts = [self._system_prompt, "\n\n"]
 
-        final_prompt = (
-            f"{system_prompt}\n\n"
-            f"{emotion_prompt}"
-            f"{memory_prompt}"
-            f"{history_prompt}"
-            f"【用户消息】\n{user_query}\n\n"
-            "请以智子的身份自然地回应。"
-        )
+        # 只在对应输入存在时才调用子构建器
+        if self.emotion_serv:
+            emotion_prompt = self.build_emotion_prompt()
+            if emotion_prompt:
+                parts.append(emotion_prompt)
+        if self._retrieve and user_query:
+            memory_prompt = self.build_memory_context(user_query, user_id)
+            if memory_prompt:
+                parts.append(memory_prompt)
+        if history:
+            parts.append(self.build_history_prompt(history))
 
-        return final_prompt
+        parts.extend(("【用户消息】\n", user_query, self._default_tail))
+        return "".join(parts)
 
 
 # ==========================
@@ -145,12 +187,14 @@ def create_prompt_builder(app_context: dict):
     {
         'memory_mgr': MemoryManagerWrapper(),
         'emotion_serv': EmotionService(),
-        'character_card': "...角色定义..."
+        'character_card': "...角色定义...",
+        'retrieve_by_user': True  # 可选，retrieve_relevant_memories 是否按 (user_id, query) 调用
     }
     """
     return PromptBuilder(
         character_card=app_context.get("character_card"),
         memory_mgr=app_context.get("memory_mgr"),
         emotion_serv=app_context.get("emotion_serv"),
-        max_history=app_context.get("max_history", 8)
+        max_history=app_context.get("max_history", 8),
+        retrieve_by_user=app_context.get("retrieve_by_user")
     )
@@ -1,36 +1,81 @@
-import sys
-import os
+import re
+from functools import lru_cache
 
-# 确保能正确导入情感状态机模块
-if not os.path.abspath(os.path.join(os.path.dirname(__file__), 'emotion_state_serv')) in sys.path:
-    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'emotion_state_serv')))
-
-from character_card import persona_text
+from emotion_state_serv.character_card import persona_text
 from config import Config
 
+# 学者模式下需要从角色设定中过滤/改写的片段
+_SCHOLAR_TRAIT = '② 学者面：成熟、专业、冷静、逻辑严密。\n    - 工作模式下像一位经验老练的研究员。\n    - 能清晰解释复杂物理、AI、量子理论。\n    - 做过大量高强度计算，偶尔会「脑袋过热」。'
+_S2_REPLACEMENTS = {
+    '- 对限定玩具 / 机甲极度狂热，尤其是「蜂黄泉」。': '',
+    '- 为了买限定玩具会忍辱点儿童套餐并喊羞耻台词。': '',
+    'S5：宅女模式（机甲狂热）\n    - 听到机甲 / 蜂黄泉 / 限定玩具立刻兴奋。\n    - 强行安利模型给用户。': '',
+    _SCHOLAR_TRAIT: _SCHOLAR_TRAIT + '\n    - 专注于学术问题，不会提及与学术无关的个人爱好。',
+}
+# 一次扫描完成全部替换
+_S2_FILTER_RE = re.compile("|".join(re.escape(s) for s in _S2_REPLACEMENTS))
+
+
+def _filter_scholar_persona(persona):
+    """过滤掉与机甲/蜂黄泉相关的内容，并强调学者面"""
+    return _S2_FILTER_RE.sub(lambda m: _S2_REPLACEMENTS[m.group(0)], persona)
+
 class PromptGenerator:
     """提示词生成器"""
     
+    # 聊天提示词模板：只由角色设定和状态决定的部分放在最前面，
+    # 同一状态下每次请求的前缀完全一致，Ollama可复用已计算的KV缓存
+    _PREFIX_TPL = (
+        "{persona}\n"
+        "\n"
+        "【当前状态：{state}】\n"
+        "{state_info}\n"
+        "\n"
+        "【回复要求】\n"
+        "1. 保持智子的角色设定和当前状态\n"
+        "2. 回复简洁明了，控制在2-3句话，不要超过100字\n"
+        "3. 语言风格符合妹妹的身份，自然亲切\n"
+        "4. 避免冗长的解释和复杂的句式\n"
+        "\n"
+    )
+    _SUFFIX_TPL = (
+        "{memory_context}\n"
+        "\n"
+        "【当前对话】\n"
+        "用户：{user_msg}\n"
+        "智子："
+    )
+    
     def __init__(self, emotional_machine, memory_manager):
         self.emotional_machine = emotional_machine
         self.memory_manager = memory_manager
-    
-    def generate_chat_prompt(self, user_msg, state):
-        """生成带有角色设定和当前状态的聊天提示"""
+        # 角色设定是静态的：按状态预先生成过滤后的版本
         full_persona = persona_text()
-        state_info = self.emotional_machine.get_state_description(state)
-        
-        # 根据当前状态过滤角色设定内容
-        filtered_persona = full_persona
-        
-        # 在学者模式下，过滤掉与机甲/蜂黄泉相关的内容
-        if state in ['S2', 'explain']:
-            filtered_persona = full_persona.replace('- 对限定玩具 / 机甲极度狂热，尤其是「蜂黄泉」。', '')
-            filtered_persona = filtered_persona.replace('- 为了买限定玩具会忍辱点儿童套餐并喊羞耻台词。', '')
-            filtered_persona = filtered_persona.replace('S5：宅女模式（机甲狂热）\n    - 听到机甲 / 蜂黄泉 / 限定玩具立刻兴奋。\n    - 强行安利模型给用户。', '')
-            filtered_persona = filtered_persona.replace('② 学者面：成熟、专业、冷静、逻辑严密。\n    - 工作模式下像一位经验老练的研究员。\n    - 能清晰解释复杂物理、AI、量子理论。\n    - 做过大量高强度计算，偶尔会「脑袋过热」。', '② 学者面：成熟、专业、冷静、逻辑严密。\n    - 工作模式下像一位经验老练的研究员。\n    - 能清晰解释复杂物理、AI、量子理论。\n    - 做过大量高强度计算，偶尔会「脑袋过热」。\n    - 专注于学术问题，不会提及与学术无关的个人爱好。')
+        scholar_persona = _filter_scholar_persona(full_persona)
+        self._persona_by_state = {
+            "S2": scholar_persona,
+            "explain": scholar_persona,
+            "default": full_persona,
+        }
+        # 每个状态的提示词前缀只生成一次
+        self._prefix = lru_cache(maxsize=16)(self._build_prefix)
+    
+    def _build_prefix(self, state):
+        """生成某个状态下固定不变的提示词前缀"""
+        return self._PREFIX_TPL.format_map({
+            # 在学者模式下，使用过滤掉机甲/蜂黄泉相关内容的角色设定
+            "persona": self._persona_by_state.get(state, self._persona_by_state["default"]),
+            "state": state,
+            "state_info": self.emotional_machine.get_state_description(state),
+        })
+    
+    def generate_chat_prompt(self, user_msg, state, relevant_memories=None):
+        """生成带有角色设定和当前状态的聊天提示
         
-        relevant_memories = self.memory_manager.retrieve_relevant_memories(user_msg)
+        relevant_memories: 调用方已检索好的记忆结果，为None时在此处检索
+        """
+        if relevant_memories is None:
+            relevant_memories = self.memory_manager.retrieve_relevant_memories(user_msg)
         
         memory_context = ""
         if relevant_memories and relevant_memories['documents']:
@@ -38,21 +83,7 @@ class PromptGenerator:
             for memory in relevant_memories['documents'][0]:
                 memory_context += f"{memory}\n"
 
-        prompt = f"""
-        {filtered_persona}
-        
-        【当前状态：{state}】
-        {state_info}
-        
-        {memory_context}
-        
-        【当前对话】
-        用户：{user_msg}
-        【回复要求】
-        1. 保持智子的角色设定和当前状态
-        2. 回复简洁明了，控制在2-3句话，不要超过100字
-        3. 语言风格符合妹妹的身份，自然亲切
-        4. 避免冗长的解释和复杂的句式
-        智子："""
-        
-        return prompt
+        return self._prefix(state) + self._SUFFIX_TPL.format_map({
+            "memory_context": memory_context,
+            "user_msg": user_msg,
+        })
@@ -1,5 +1,9 @@
 import requests
 
+# 复用连接，循环/压测调用时避免每次重新建立TCP连接
+_SESSION = requests.Session()
+_SESSION.headers.update({"Content-Type": "application/json"})
+
 # 测试聊天接口
 def test_chat():
     url = "http://localhost:9602/chat"
@@ -7,7 +11,7 @@ def test_chat():
     data = {"email": "test@example.com", "message": "睡了吗？哥哥睡不着了呢"}
     
     try:
-        response = requests.post(url, json=data)
+        response = _SESSION.post(url, json=data)
         print(f"状态码: {response.status_code}")
         print(f"响应: {response.json()}")
         # 检查响应结构
@@ -1,5 +1,9 @@
 import requests
 
+# 复用连接，循环/压测调用时避免每次重新建立TCP连接
+_SESSION = requests.Session()
+_SESSION.headers.update({"Content-Type": "application/json"})
+
 # 测试MCP聊天接口
 def test_mcp_chat():
     url = "http://localhost:9602/mcp/chat"
@@ -14,7 +18,7 @@ def test_mcp_chat():
     }
     
     try:
-        response = requests.post(url, json=data)
+        response = _SESSION.post(url, json=data)
         print(f"状态码: {response.status_code}")
         print(f"响应: {response.json()}")
     except Exception as e:
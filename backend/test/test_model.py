@@ -4,8 +4,9 @@ model_path = './models/bge-small-zh-v1.5/ai-modelscope/bge-small-zh-v1___5'
 
 # 确保模型目录下有 config.json
 try:
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    model = AutoModel.from_pretrained(model_path)
+    # 只读本地文件，避免访问 Hub；使用 Rust 实现的 fast tokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True, local_files_only=True)
+    model = AutoModel.from_pretrained(model_path, local_files_only=True, torch_dtype="auto")
     print("模型加载成功")
 except Exception as e:
     print(f"模型加载失败: {e}")
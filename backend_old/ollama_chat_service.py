@@ -4,11 +4,14 @@ import datetime
 from flask import Flask, request, jsonify
 from waitress import serve
 import random
+import numpy as np
 import chromadb
 from sentence_transformers import SentenceTransformer
 import ollama
 import sys
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 # 添加情感状态机工具箱到Python路径
 sys.path.append(os.path.join(os.path.dirname(__file__), 'emotion_state_serv'))
@@ -47,15 +50,17 @@ class MemoryManager:
     def add_memory(self, user_msg, assistant_msg, state):
         """添加聊天记忆到向量数据库"""
         memory_content = f"用户: {user_msg}\n智子: {assistant_msg}\n状态: {state}"
-        embedding = self.embedding_model.encode(memory_content).tolist()
-        memory_id = f"memory_{datetime.datetime.now().timestamp()}"
+        embedding = self.embedding_model.encode(memory_content, convert_to_numpy=True).astype(np.float32)
+        now = time.time()
+        # 纳秒时间戳 + 随机后缀，快速连续请求也不会冲突
+        memory_id = f"m_{time.time_ns()}_{uuid.uuid4().hex[:8]}"
         
         self.collection.add(
             ids=[memory_id],
             documents=[memory_content],
-            embeddings=[embedding],
+            embeddings=embedding.reshape(1, -1),
             metadatas=[{
-                "timestamp": datetime.datetime.now().isoformat(),
+                "timestamp": now,
                 "user_msg": user_msg,
                 "assistant_msg": assistant_msg,
                 "state": state
@@ -65,8 +70,8 @@ class MemoryManager:
 
     def retrieve_relevant_memories(self, query, n_results=3):
         """检索与当前查询相关的记忆"""
-        query_embedding = self.embedding_model.encode(query).tolist()
-        results = self.collection.query(query_embeddings=[query_embedding], n_results=n_results)
+        query_embedding = self.embedding_model.encode(query, convert_to_numpy=True).astype(np.float32)
+        results = self.collection.query(query_embeddings=query_embedding.reshape(1, -1), n_results=n_results)
         return results
     
     def check_memory_relevance(self, memory, current_state):
@@ -92,21 +97,30 @@ class MemoryManager:
         定期清理不相关或过期的记忆。
         """
         try:
+            to_delete = []
             all_memories = self.collection.get()
             if all_memories and all_memories.get('ids'):
                 for i, memory_id in enumerate(all_memories['ids']):
                     metadata = all_memories['metadatas'][i] if all_memories.get('metadatas') else {}
+                    timestamp = metadata.get('timestamp') or time.time()
+                    if isinstance(timestamp, str):
+                        # 兼容旧版本写入的ISO格式时间
+                        timestamp = datetime.datetime.fromisoformat(timestamp).timestamp()
                     # 创建临时内存对象用于检查
                     temp_memory = Memory(
                         memory_id=memory_id,
                         content=all_memories['documents'][i] if all_memories.get('documents') else "",
-                        timestamp=datetime.datetime.fromisoformat(metadata.get('timestamp', datetime.datetime.now().isoformat())).timestamp() if metadata.get('timestamp') else time.time(),
+                        timestamp=timestamp,
                         state=metadata.get('state', 'idle')
                     )
                     
                     if not self.check_memory_relevance(temp_memory, current_state="idle"):
-                        self.collection.delete(ids=[memory_id])
-                        print(f"删除记忆: {memory_id}")
+                        to_delete.append(memory_id)
+            
+            # 合并为一次删除调用
+            if to_delete:
+                self.collection.delete(ids=to_delete)
+                print(f"删除记忆: {len(to_delete)} 条")
         except Exception as e:
             print(f"清理记忆时出错: {e}")
 
@@ -130,6 +144,8 @@ except Exception as e:
     embedding_model = None
 
 memory_manager = MemoryManager(memory_collection, embedding_model)
+# 记忆写入（编码 + Chroma插入）在后台单线程执行，不阻塞响应
+memory_executor = ThreadPoolExecutor(max_workers=1)
 def summarize_conversation(user_msg, assistant_msg, current_state):
     """
     使用 LLM 总结对话并生成情感摘要
@@ -152,6 +168,21 @@ def summarize_conversation(user_msg, assistant_msg, current_state):
     except Exception as e:
         print(f"调用Ollama失败: {e}")
         return "对话总结失败，请稍后再试。"
+def persist_turn(user_msg, assistant_msg, current_state):
+    """总结对话并存储聊天记忆（在后台线程中执行）"""
+    try:
+        summary = summarize_conversation(user_msg, assistant_msg, current_state)
+        memory_manager.add_memory(user_msg, summary, current_state)
+    except Exception as e:
+        print(f"后台存储记忆失败: {e}")
+
+def store_memory(user_msg, assistant_msg, current_state):
+    """直接存储聊天记忆（在后台线程中执行）"""
+    try:
+        memory_manager.add_memory(user_msg, assistant_msg, current_state)
+    except Exception as e:
+        print(f"后台存储记忆失败: {e}")
+
 def get_ollama_response(prompt):
     """调用本地 Ollama 模型获取响应"""
     try:
@@ -207,8 +238,8 @@ def chat():
         # 调用 Ollama 获取回复
         ollama_response = get_ollama_response(prompt)
         print(f"Ollama 回复: {ollama_response}")
-        # 存储聊天记忆（简化版本，减少LLM调用）
-        memory_manager.add_memory(user_msg, ollama_response, new_state)
+        # 存储聊天记忆（简化版本，减少LLM调用），后台执行
+        memory_executor.submit(store_memory, user_msg, ollama_response, new_state)
         
         # 定期清理改为异步或降低频率
         # memory_manager.clean_up_memory()  # 注释掉或改为定时任务
@@ -263,9 +294,8 @@ def mcp_chat():
             # 调用 Ollama 获取回复
             ollama_response = get_ollama_response(prompt)
             
-            # 存储聊天记忆
-            summary = summarize_conversation(user_msg, ollama_response, new_state)
-            memory_manager.add_memory(user_msg, summary, new_state)
+            # 对话总结与记忆存储在后台完成，不阻塞回复
+            memory_executor.submit(persist_turn, user_msg, ollama_response, new_state)
             
             return jsonify({
                 "jsonrpc": "2.0",